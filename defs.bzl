@@ -12,6 +12,9 @@ def _peotry_import_impl(repo_ctx):
     for k, v in repo_ctx.attr.override_pkg.items():
         cmd.extend(["--override-pkg", "{}={}".format(k, v)])
 
+    if repo_ctx.attr.use_legacy_redirect:
+        cmd.append("--use-legacy-redirect")
+
     result = repo_ctx.execute(cmd)
 
     if repo_ctx.attr.verbose:
@@ -89,6 +92,9 @@ poetry_import = repository_rule(
         "override_pkg": attr.string_dict(
             doc="Mapping of package names to Bazel labels to override in the dependency graph"
         ),
+        "use_legacy_redirect": attr.bool(
+            doc="Resolve wheel URLs through PyPI's legacy redirect endpoint before the JSON API"
+        ),
         "verbose": attr.bool(),
     },
     implementation = _peotry_import_impl
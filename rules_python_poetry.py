@@ -9,42 +9,81 @@ VENDORED_DEPS = [
     "third_party/tomlkit-0.7.0-py2.py3-none-any.whl",
     "third_party/urllib3-1.26.4-py2.py3-none-any.whl",
 ]
-for dep in VENDORED_DEPS:
-    sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), dep))
 
 import argparse
 import atexit
+import concurrent.futures
+import functools
 import json
-from packaging.markers import Marker, UndefinedEnvironmentName, Variable
-import packaging.tags
-import tomlkit
-import urllib3
+import urllib.parse
 
 # TODO:
 # - Better verbose rule attr
 # - maybe-ify workspace rules?
 
-HTTP_ARCHIVE_TEMPLATE = """
-    http_archive(
-        name = "{name}",
-        build_file_content = {build_file_content},
-        sha256 = "{sha256}",
-        type = "zip",
-        urls = [
-            "{url}",
-        ],
-    )
+# Marker string -> evaluation result. The target environment doesn't change during a run, and
+# many dependencies share identical markers.
+_MARKER_CACHE = {}
 
+
+def add_vendored_deps_to_path():
+    """
+    Makes the vendored wheels importable. Anything importing from them does so lazily, so argument
+    parsing (and --help) doesn't pay for zipimporting packages it never uses.
     """
+    for dep in VENDORED_DEPS:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), dep))
+
+
+def load_lock_file(path):
+    """
+    Parses a poetry.lock file. We never write the lock file back, so prefer a plain TOML parser
+    (tomllib from Python 3.11+, or tomli if installed) over the style-preserving vendored tomlkit.
+    """
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            tomllib = None
+
+    if tomllib:
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+
+    import tomlkit
+
+    with open(path, "r") as f:
+        return tomlkit.parse(f.read())
+
+
+@functools.lru_cache(maxsize=None)
+def import_orjson():
+    "Optional, but considerably faster at decoding large PyPI metadata responses"
+
+    try:
+        import orjson
+    except ImportError:
+        return None
+
+    return orjson
 
-SDIST_BUILD_TEMPLATE = """
-    pip_install_sdist(
-        name = "{name}",
-        build_file_content = {build_file_content},
-        sha256 = "{sha256}",
-        url = "{url}",
-    )
-"""
+
+def json_loads(data: bytes):
+    orjson = import_orjson()
+    if orjson:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+
+def json_dumps(obj) -> bytes:
+    orjson = import_orjson()
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+    return json.dumps(obj, indent=4).encode()
 
 
 class PyPILinkResolver:
@@ -59,17 +98,40 @@ class PyPILinkResolver:
     the expected `py2.py3`.
 
     Given that the endpoint simply calls the public JSON API to redirect to the canonical url [2],
-    we're going to do the same here.
+    we're going to do the same here. With use_legacy_redirect, the endpoint is tried first anyway:
+    a HEAD request is far cheaper than the full JSON metadata, and we fall back to the JSON API
+    for any file it doesn't redirect.
 
     [1] https://files.pythonhosted.org/packages/python_version/p/package/package-ver-pyver-abi-plat.whl
     [2] https://github.com/pypa/conveyor/blob/master/conveyor/views.py#L74-L75
     """
 
-    def __init__(self):
-        self._pool = urllib3.PoolManager()
+    # Upper bound on concurrent PyPI metadata requests
+    MAX_WORKERS = 16
+
+    def __init__(self, use_legacy_redirect: bool = False):
+        import urllib3
+
+        self._use_legacy_redirect = use_legacy_redirect
+        self._pool = urllib3.PoolManager(
+            num_pools=4,
+            # Allow one connection per worker so concurrent fetches don't serialize on the pool
+            maxsize=self.MAX_WORKERS,
+            block=False,
+            # Don't let a transient PyPI error fail the whole import. Once retries are exhausted,
+            # the last response is returned so _get_metadata can report its status.
+            retries=urllib3.Retry(
+                total=5,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                raise_on_status=False,
+            ),
+            timeout=urllib3.Timeout(connect=5.0, read=30.0),
+            headers={"Accept-Encoding": "gzip"},
+        )
         self._cache = {}
+        self._cache_loaded = False
         self._cache_modified = False
-        self._load_cache()
         atexit.register(self._save_cache)
 
     def _cache_path(self):
@@ -81,9 +143,15 @@ class PyPILinkResolver:
         return os.path.join(base_path, "rules_python_poetry", "pypi_cache.json")
 
     def _load_cache(self):
+        "Loads the on-disk cache the first time it's needed, e.g. never for sdist-only lock files"
+
+        if self._cache_loaded:
+            return
+
+        self._cache_loaded = True
         try:
-            with open(self._cache_path(), "r") as f:
-                saved_cache = json.load(f)
+            with open(self._cache_path(), "rb") as f:
+                saved_cache = json_loads(f.read())
 
             if isinstance(saved_cache, dict) and saved_cache.get("version") == 1:
                 self._cache = saved_cache["data"]
@@ -96,8 +164,18 @@ class PyPILinkResolver:
 
         cache_path = self._cache_path()
         os.makedirs(os.path.dirname(cache_path), mode=0o755, exist_ok=True)
-        with open(cache_path, "w") as f:
-            json.dump({"version": 1, "data": self._cache}, f, indent=4)
+
+        # Write to a temporary file first so an interrupted run can't leave a corrupt cache behind
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(json_dumps({"version": 1, "data": self._cache}))
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            # Don't leave a stray temporary file behind for every failed run
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
 
     def _get_metadata(self, pkg: str):
         response = self._pool.request("GET", f"https://pypi.org/pypi/{pkg}/json")
@@ -110,98 +188,228 @@ class PyPILinkResolver:
                 f"Failed to get PyPI metadata for {pkg} with http status {response.status}"
             )
 
-        return json.loads(response.data.decode())
+        return json_loads(response.data)
+
+    def _get_redirect_url(self, pkg: str, filename: str):
+        """
+        Asks the legacy endpoint where a wheel lives, returning None if it doesn't redirect us or
+        the request fails, so that the caller can fall back to the JSON API
+        """
+        import urllib3
+
+        python_version = filename[: -len(".whl")].rsplit("-", 3)[1]
+        legacy_url = (
+            f"https://files.pythonhosted.org/packages/{python_version}/{pkg[0]}/{pkg}/{filename}"
+        )
+
+        try:
+            response = self._pool.request("HEAD", legacy_url, redirect=False)
+        except urllib3.exceptions.HTTPError as e:
+            print(f"Legacy endpoint failed for {filename}: {e}")
+            return None
+
+        location = response.headers.get("Location")
+        if response.status in (301, 302, 303, 307, 308) and location:
+            return urllib.parse.urljoin(legacy_url, location)
+
+        return None
+
+    def _cache_metadata(self, pkg_metadata, version: str):
+        """
+        Caches the URLs of every file in the locked release, not just the one we're looking for.
+        Other releases are skipped so the cache doesn't grow with each package's whole history.
+        """
+        for file in pkg_metadata["releases"].get(version, []):
+            self._cache[file["digests"]["sha256"]] = file["url"]
+
+        self._cache_modified = True
+
+    def _cache_redirect_url(self, sha256: str, url: str):
+        # PyPI filenames are unique and immutable, and the legacy endpoint redirects by exact
+        # filename, so this is as trustworthy as a JSON API result. Either way, Bazel verifies
+        # the sha256 when downloading.
+        self._cache[sha256] = url
+        self._cache_modified = True
+
+    def prefetch(self, files):
+        """
+        Resolves every (pkg, version, sha256, filename) in files that isn't already cached,
+        concurrently. Resolving each file one at a time is dominated by network latency.
+        """
+        if not files:
+            return
+
+        self._load_cache()
+
+        missing = [f for f in files if f[2] not in self._cache]
+        if not missing:
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            redirect_futures = {}
+            metadata_futures = {}
+            requested_releases = set()
+
+            def fetch_metadata(pkg, version):
+                if (pkg, version) in requested_releases:
+                    return None
+
+                requested_releases.add((pkg, version))
+                future = executor.submit(self._get_metadata, pkg)
+                metadata_futures[future] = version
+                return future
+
+            pending = set()
+            for f in missing:
+                pkg, version, sha256, filename = f
+                if self._use_legacy_redirect:
+                    future = executor.submit(self._get_redirect_url, pkg, filename)
+                    redirect_futures[future] = f
+                else:
+                    future = fetch_metadata(pkg, version)
+
+                if future:
+                    pending.add(future)
+
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+
+                for future in done:
+                    if future in metadata_futures:
+                        self._cache_metadata(future.result(), metadata_futures[future])
+                        continue
+
+                    pkg, version, sha256, filename = redirect_futures[future]
+                    url = future.result()
+                    if url:
+                        self._cache_redirect_url(sha256, url)
+                        continue
+
+                    # Fall back to the JSON API as soon as the legacy endpoint lets us down,
+                    # rather than waiting for the rest of the HEAD requests
+                    fallback = fetch_metadata(pkg, version)
+                    if fallback:
+                        pending.add(fallback)
+
+        for pkg, version, sha256, filename in missing:
+            url = self._cache.get(sha256)
+            if url:
+                print(f"Found {filename} at {url}")
+
+    def get_url(self, pkg: str, version: str, sha256: str, filename: str) -> str:
+        self._load_cache()
 
-    def get_url(self, pkg: str, version: str, sha256: str) -> str:
         cached_url = self._cache.get(sha256)
         if cached_url:
             return cached_url
 
-        pkg_metadata = self._get_metadata(pkg)
+        if self._use_legacy_redirect:
+            url = self._get_redirect_url(pkg, filename)
+            if url:
+                print(f"Found {filename} at {url}")
 
-        for pkg_version, files in pkg_metadata["releases"].items():
-            if pkg_version != version:
-                continue
+                self._cache_redirect_url(sha256, url)
+                return url
 
-            for file in files:
-                if file["digests"]["sha256"] != sha256:
-                    continue
+        self._cache_metadata(self._get_metadata(pkg), version)
 
-                print(f"Found {file['filename']} at {file['url']}")
+        url = self._cache.get(sha256)
+        if url:
+            print(f"Found {filename} at {url}")
 
-                self._cache[file["digests"]["sha256"]] = file["url"]
-                self._cache_modified = True
-                return file["url"]
-
-        return None
+        return url
 
 
 def remove_extra_marker(markers):
-    rewritten_markers = []
+    "Removes any \"extra\" clauses from parsed markers, rewriting the nested lists in place"
 
-    for marker in markers:
-        assert isinstance(marker, (list, tuple, str))
+    from packaging.markers import Variable
 
-        if isinstance(marker, list):
-            rewritten_markers.append(remove_extra_marker(marker))
-        elif isinstance(marker, tuple):
-            lhs, op, rhs = marker
+    pending = [markers]
+    while pending:
+        group = pending.pop()
 
-            if isinstance(lhs, Variable):
-                variable = lhs.value
-            else:
-                variable = rhs.value
+        i = 0
+        while i < len(group):
+            marker = group[i]
+            assert isinstance(marker, (list, tuple, str))
 
-            if variable == "extra":
-                continue
+            if isinstance(marker, list):
+                pending.append(marker)
+            elif isinstance(marker, tuple):
+                lhs, op, rhs = marker
 
-            rewritten_markers.append(marker)
-        else:
-            rewritten_markers.append(marker)
+                if isinstance(lhs, Variable):
+                    variable = lhs.value
+                else:
+                    variable = rhs.value
+
+                if variable == "extra":
+                    del group[i]
+                    continue
+
+            i += 1
 
-    return rewritten_markers
+    return markers
 
 
 def evaluated_deps(pkg):
     "Returns dependencies that apply to the current environment"
 
+    from packaging.markers import Marker, UndefinedEnvironmentName
+
     deps = []
-    for k, dep in pkg.get("dependencies", {}).items():
+    for k, dep in dict(pkg.get("dependencies", {})).items():
         if "markers" in dep:
-            marker = Marker(dep["markers"])
+            key = dep["markers"]
+            matches = _MARKER_CACHE.get(key)
 
-            # Remove any "extra" clauses from the marker before we evaluate it. If a package is
-            # in this list, the extra has already been matched.
-            marker._markers = remove_extra_marker(marker._markers)
+            if matches is None:
+                marker = Marker(key)
 
-            try:
-                if not marker.evaluate():
-                    continue
-            except UndefinedEnvironmentName as e:
-                print(f"Failed to evaluate marker for {pkg['name']}: {e}")
-                raise
+                # Remove any "extra" clauses from the marker before we evaluate it. If a package
+                # is in this list, the extra has already been matched.
+                marker._markers = remove_extra_marker(marker._markers)
+
+                try:
+                    matches = marker.evaluate()
+                except UndefinedEnvironmentName as e:
+                    print(f"Failed to evaluate marker for {pkg['name']}: {e}")
+                    raise
+
+                _MARKER_CACHE[key] = matches
+
+            if not matches:
+                continue
 
         deps.append(k)
     return deps
 
 
+@functools.lru_cache(maxsize=None)
 def extract_wheel_filename_tags(filename):
     "Extracts tags from a wheel filename"
 
+    import packaging.tags
+
     assert filename.endswith(".whl")
     filename = filename[:-4]
     _, interpreters, abis, platforms = filename.rsplit("-", 3)
 
-    for interpreter in interpreters.split("."):
-        for abi in abis.split("."):
-            for platform in platforms.split("."):
-                yield packaging.tags.Tag(interpreter, abi, platform)
+    return tuple(
+        packaging.tags.Tag(interpreter, abi, platform)
+        for interpreter in interpreters.split(".")
+        for abi in abis.split(".")
+        for platform in platforms.split(".")
+    )
 
 
-def best_compatible_file(files, compatible_tags):
+def best_compatible_file(files, tag_index):
     """
-    Given a list files for a package, pick the most applicable one. This assumes that the
-    best-matching tag comes first in compatible_tags.
+    Given a list files for a package, pick the most applicable one. tag_index maps each compatible
+    tag to its priority, with 0 being the best match.
     """
     source_dist = None
     best_wheel = None
@@ -212,15 +420,18 @@ def best_compatible_file(files, compatible_tags):
 
         if filename.endswith(".whl"):
             for tag in extract_wheel_filename_tags(filename):
-                try:
-                    compatible_tag_index = compatible_tags.index(tag)
-
-                    if not best_wheel or compatible_tag_index < best_wheel_tag_idx:
-                        best_wheel = f
-                        best_wheel_tag_idx = compatible_tag_index
-                except ValueError:
+                compatible_tag_index = tag_index.get(tag)
+                if compatible_tag_index is None:
                     # Wheel is not compatible
-                    pass
+                    continue
+
+                if not best_wheel or compatible_tag_index < best_wheel_tag_idx:
+                    best_wheel = f
+                    best_wheel_tag_idx = compatible_tag_index
+
+                if best_wheel_tag_idx == 0:
+                    # Nothing can beat the highest priority tag, and wheels win over sdists
+                    return {"type": "wheel", **best_wheel}
         # FIXME: Are there any other extensions we need to care about?
         elif filename.endswith(".tar.gz") or filename.endswith(".zip"):
             source_dist = f
@@ -237,34 +448,38 @@ def best_compatible_file(files, compatible_tags):
 def format_bazel_dist(bazel_workspace_name, dist, deps):
     "Formats bazel workspace rule for a wheel or sdist package"
 
-    templated_build_contents = (
-        """render_package_build(name="{workspace_name}", deps=[{deps}])""".format(
-            workspace_name=bazel_workspace_name,
-            deps=",".join(f'pypi("{dep}")' for dep in deps),
-        )
-    )
+    deps_list = ",".join(f'pypi("{dep}")' for dep in deps)
+    build_file_content = f'render_package_build(name="{bazel_workspace_name}", deps=[{deps_list}])'
 
     file_sha256 = dist["hash"][len("sha256:") :]
     url = dist["url"]
 
     if dist["type"] == "wheel":
-        return HTTP_ARCHIVE_TEMPLATE.format(
-            name=bazel_workspace_name,
-            build_file_content=templated_build_contents,
-            sha256=file_sha256,
-            url=url,
-        )
+        return f"""
+    http_archive(
+        name = "{bazel_workspace_name}",
+        build_file_content = {build_file_content},
+        sha256 = "{file_sha256}",
+        type = "zip",
+        urls = [
+            "{url}",
+        ],
+    )
+
+    """
 
     if dist["type"] == "source":
         # Build time deps? Not much we can do here:
         # - https://github.com/python-poetry/poetry/issues/1307
         # - https://github.com/python-poetry/poetry/issues/2778
-        return SDIST_BUILD_TEMPLATE.format(
-            name=bazel_workspace_name,
-            build_file_content=templated_build_contents,
-            sha256=file_sha256,
-            url=url,
-        )
+        return f"""
+    pip_install_sdist(
+        name = "{bazel_workspace_name}",
+        build_file_content = {build_file_content},
+        sha256 = "{file_sha256}",
+        url = "{url}",
+    )
+"""
 
 
 def get_dist_url(dist, pkg, pypi_resolver: PyPILinkResolver):
@@ -272,7 +487,7 @@ def get_dist_url(dist, pkg, pypi_resolver: PyPILinkResolver):
     file_sha256 = dist["hash"][len("sha256:") :]
 
     if dist["type"] == "wheel":
-        url = pypi_resolver.get_url(pkg["name"], pkg["version"], file_sha256)
+        url = pypi_resolver.get_url(pkg["name"], pkg["version"], file_sha256, dist["file"])
         if not url:
             raise Exception(f"Could not resolve PyPI url for {dist['file']}")
 
@@ -291,12 +506,26 @@ def main():
     parser.add_argument(
         "--override-pkg", action="append", type=lambda kv: kv.split("=", 1)
     )
+    parser.add_argument(
+        "--use-legacy-redirect",
+        action="store_true",
+        help="Resolve wheel URLs through PyPI's legacy redirect endpoint before the JSON API",
+    )
     args = parser.parse_args()
 
-    lock_file = tomlkit.parse(open(args.lock_file, "r").read())
+    add_vendored_deps_to_path()
+    import packaging.tags
 
-    output = open("packages.bzl", "w")
-    output.write(
+    lock_file = load_lock_file(args.lock_file)
+
+    # When falling back to tomlkit, its containers are much slower to index than native dicts and
+    # lists
+    files_by_pkg = dict(lock_file["metadata"]["files"])
+    packages_list = list(lock_file["package"])
+
+    # Collect the generated file in memory and write it out in one go
+    output = []
+    output.append(
         """# Generated by rules_python_poetry
 # DO NOT EDIT!
 
@@ -335,19 +564,25 @@ def pypi(name):
     )
 
     compatible_tags = list(packaging.tags.sys_tags())
-    pypi_resolver = PyPILinkResolver()
+    tag_index = {}
+    for i, tag in enumerate(compatible_tags):
+        # Keep the highest priority if a tag shows up more than once
+        tag_index.setdefault(tag, i)
+    pypi_resolver = PyPILinkResolver(use_legacy_redirect=args.use_legacy_redirect)
     packages = {}
 
-    output.write("def python_deps():\n")
-    for pkg in lock_file["package"]:
+    # Pick the distribution for each package up front so we can resolve their URLs in bulk
+    selected = []
+    for pkg in packages_list:
+        pkg = dict(pkg)
         if pkg.get("source"):
             # For git via pip: {url}@{resolved_resource_reference}#egg={package_name}
             print(f'FIXME: Need to build {pkg["name"]} from source repo!')
             continue
 
-        files = lock_file["metadata"]["files"][pkg["name"]]
+        files = files_by_pkg[pkg["name"]]
 
-        dist = best_compatible_file(files, compatible_tags)
+        dist = best_compatible_file(files, tag_index)
         if not dist:
             # Some packages don't have a source distribution available and none of the wheels might
             # be compatible, e.g, pywin32 on a non-Windows platform. If the package is actually
@@ -356,29 +591,40 @@ def pypi(name):
             print(f'Did not find a compatible file for {pkg["name"]} {pkg["version"]}')
             continue
 
+        selected.append((pkg, dist))
+
+    pypi_resolver.prefetch(
+        [
+            (pkg["name"], pkg["version"], dist["hash"][len("sha256:") :], dist["file"])
+            for pkg, dist in selected
+            if dist["type"] == "wheel"
+        ]
+    )
+
+    output.append("def python_deps():\n")
+    for pkg, dist in selected:
         dist["url"] = get_dist_url(dist, pkg, pypi_resolver)
 
         # Collect dependencies that apply to the current environment
         deps = evaluated_deps(pkg)
 
         bazel_workspace_name = f"{args.root_workspace}__{pkg['name']}-{pkg['version']}"
-        output.write(format_bazel_dist(bazel_workspace_name, dist, deps))
+        output.append(format_bazel_dist(bazel_workspace_name, dist, deps))
 
         packages[pkg["name"]] = f"@{bazel_workspace_name}"
-    output.write("\n")
+    output.append("\n")
 
     # package -> bazel label mapping
     if args.override_pkg:
         packages = {**packages, **dict(args.override_pkg)}
 
-    output.write("packages = {\n")
-
-    for p, label in packages.items():
-        output.write(f'  "{p}": "{label}",\n')
+    output.append("packages = {\n")
+    output.append("".join(f'  "{p}": "{label}",\n' for p, label in packages.items()))
+    output.append("}\n")
+    output.append("all_requirements = packages.values()\n")
 
-    output.write("}\n")
-    output.write("all_requirements = packages.values()\n")
-    output.close()
+    with open("packages.bzl", "w") as f:
+        f.write("".join(output))
 
     # requirements.bzl shim
     with open("requirements.bzl", "w") as f: